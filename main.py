@@ -1,16 +1,34 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 import os
+import asyncio
+from contextlib import asynccontextmanager, suppress
 import weaviate
 from weaviate.auth import AuthApiKey
+from weaviate.classes.query import Filter, HybridFusion, MetadataQuery
+from weaviate.config import AdditionalConfig, ConnectionConfig, Timeout
 import openai
-from pydantic import BaseModel
+import aiohttp
+from pydantic import BaseModel, constr
 import datetime
+import logging
+import logging.handlers
 import csv
+import functools
+import operator
+import queue
+import re
+import threading
+import time
+from itertools import chain
+from importlib import resources
 import spacy
-from textblob import TextBlob
-from rapidfuzz import process as rapidfuzz_process
+from symspellpy import SymSpell
+import numpy as np
+from rapidfuzz import fuzz, process as rapidfuzz_process
+from cachetools import LRUCache, TTLCache
 
 REWRITE_SYSTEM_PROMPT = """
 You are assisting CA Final students in navigating a structured academic question bank to retrieve the most relevant questions from specific categories.
@@ -48,20 +66,74 @@ command_filters = {
     "%all": ["example", "illustration", "test your knowledge", "mtp", "rtp", "past papers", "other"]
 }
 
-ENABLE_SPELL_CORRECTION = False  # Set to True if you want spelling correction
+RESULT_PROPERTIES = [
+    "chapter", "sourceDetails", "sourceType", "conceptTested",
+    "conceptSummary", "question", "answer", "howToApproach"
+]
+MAX_RESULTS = 50
+HASHTAG_CANDIDATE_LIMIT = 1000  # Rows fetched for a hashtag before the exact-phrase check
+MIN_QUERY_LENGTH = 2
+MAX_QUERY_LENGTH = 200
+LOG_PATH = "query_log.csv"
+LOG_HEADER = ["Timestamp", "Original", "Rewritten", "Method", "Count"]
+LOG_BATCH_SIZE = 64
+LOG_BATCH_WAIT = 0.1  # Seconds to wait for more rows before writing a batch
+LOG_DRAIN_TIMEOUT = 5  # Seconds shutdown waits for queued rows before giving up on them
+TOKENIZE_BATCH_WAIT = 0.005  # Seconds to collect concurrent queries into one nlp.pipe call
+QUERY_CACHE_SIZE = 1000  # Queries whose results are kept for reuse
+QUERY_CACHE_THRESHOLD = 95  # token_sort_ratio at which a new query reuses a cached one with the same numbers
+QUERY_CACHE_TTL = 3600  # Seconds before cached results are dropped and searched again
+TAG_CACHE_TTL = 300  # Seconds before the tag vocabulary is re-read from Weaviate
+WARMUP_INTERVAL = 240  # Seconds between keep-warm refreshes; kept below TAG_CACHE_TTL so tags never expire
 
-def correct_spelling(text): return str(TextBlob(text).correct())
+ENABLE_SPELL_CORRECTION = False  # Set to True if you want spelling correction
 
-def rewrite_query(text):
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": REWRITE_SYSTEM_PROMPT},
-            {"role": "user", "content": f"Rewrite this CA Final query: {text}"}
-        ],
-        temperature=0.2
+# Loaded on the first spell check; prefix_length=5 keeps the index at ~38 MB instead of ~137 MB
+@functools.lru_cache(maxsize=1)
+def get_sym_spell():
+    sym_spell = SymSpell(max_dictionary_edit_distance=2, prefix_length=5)
+    sym_spell.load_dictionary(
+        str(resources.files("symspellpy") / "frequency_dictionary_en_82_765.txt"),
+        term_index=0,
+        count_index=1
     )
-    return response.choices[0].message.content.strip()
+    return sym_spell
+
+@functools.lru_cache(maxsize=4096)
+def correct_spelling(text):
+    # ignore_non_words keeps numbers and acronyms such as "126" or "NRV" untouched
+    suggestions = get_sym_spell().lookup_compound(text, max_edit_distance=2, ignore_non_words=True)
+    return suggestions[0].term if suggestions else text
+
+_rewrite_cache = LRUCache(maxsize=1024)
+
+async def rewrite_query(text):
+    # Collapse whitespace so trivially different inputs share one cache entry
+    text = " ".join(text.split())
+    rewritten = _rewrite_cache.get(text)
+    if rewritten is None:
+        response = await openai.ChatCompletion.acreate(
+            model="gpt-3.5-turbo",
+            messages=[
+                {"role": "system", "content": REWRITE_SYSTEM_PROMPT},
+                {"role": "user", "content": f"Rewrite this CA Final query: {text}"}
+            ],
+            temperature=0.2
+        )
+        rewritten = response.choices[0].message.content.strip()
+        _rewrite_cache[text] = rewritten
+    return rewritten
+
+# ✅ Log through a queue so formatting and stderr writes happen on a background thread
+logger = logging.getLogger("ca_final_backend")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_console_log_queue = queue.Queue(-1)
+logger.addHandler(logging.handlers.QueueHandler(_console_log_queue))
+_console_handler = logging.StreamHandler()
+_console_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+console_listener = logging.handlers.QueueListener(_console_log_queue, _console_handler)
+console_listener.start()
 
 # ✅ Load .env variables
 load_dotenv()
@@ -69,17 +141,56 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 WEAVIATE_API_KEY = os.getenv("WEAVIATE_API_KEY")
 WEAVIATE_URL = os.getenv("WEAVIATE_URL")
 
-# ✅ Initialize OpenAI client (new API style)
-import openai  # ✅ make sure this is also imported at the top
+# ✅ Initialize OpenAI client
 openai.api_key = OPENAI_API_KEY  # usually from os.getenv("OPENAI_API_KEY")
 
 
 # ✅ Print just to confirm loading
-print("🔑 OpenAI Key Start:", OPENAI_API_KEY[:8])
-print("🔑 Weaviate URL:", WEAVIATE_URL)
+logger.info("🔑 OpenAI Key Start: %s", OPENAI_API_KEY[:8])
+logger.info("🔑 Weaviate URL: %s", WEAVIATE_URL)
+
+# ✅ One Weaviate client per worker, opened on startup and closed on shutdown
+@asynccontextmanager
+async def lifespan(app):
+    client_weaviate = weaviate.use_async_with_weaviate_cloud(
+        cluster_url=WEAVIATE_URL,
+        auth_credentials=AuthApiKey(WEAVIATE_API_KEY),
+        headers={"X-OpenAI-Api-Key": OPENAI_API_KEY},
+        additional_config=AdditionalConfig(
+            timeout=Timeout(init=5, query=30),
+            connection=ConnectionConfig(
+                session_pool_connections=50,
+                session_pool_maxsize=200,
+                session_pool_max_retries=3
+            )
+        ),
+    )
+    await client_weaviate.connect()
+    app.state.weaviate = client_weaviate
+    app.state.collection = client_weaviate.collections.get("FR_Inventories")  # Replace with your actual class name if different
+    # ✅ One pooled HTTP session for every OpenAI call instead of a new one per request
+    app.state.openai_session = aiohttp.ClientSession()
+    ensure_log_header()
+    threading.Thread(target=log_writer, name="query-log-writer", daemon=True).start()
+    # ✅ Pay the cold-start costs before the first user request does
+    await asyncio.to_thread(get_nlp)
+    await warm_up(app.state.collection)
+    keep_warm_task = asyncio.create_task(keep_warm(app.state.collection))
+    try:
+        yield
+    finally:
+        keep_warm_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await keep_warm_task  # Must be stopped before the client below is closed
+        # Wait for the writer off the event loop; rows still queued after the timeout are lost
+        if not await asyncio.to_thread(drain_log_queue, LOG_DRAIN_TIMEOUT):
+            logger.warning("⚠️ Query log not drained within %ss, %d rows dropped", LOG_DRAIN_TIMEOUT, log_q.unfinished_tasks)
+        await client_weaviate.close()
+        await app.state.openai_session.close()
+        console_listener.stop()
 
 # ✅ Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # ✅ Enable CORS for frontend access
 app.add_middleware(
@@ -90,14 +201,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-client_weaviate = weaviate.connect_to_weaviate_cloud(
-    cluster_url=WEAVIATE_URL,
-    auth_credentials=AuthApiKey(WEAVIATE_API_KEY),
-    headers={"X-OpenAI-Api-Key": OPENAI_API_KEY},
-)
-
-nlp = spacy.load("en_core_web_sm")  # Load the NLP model
-collection = client_weaviate.collections.get("FR_Inventories")  # Replace with your actual class name if different
+# Only lemmas, stop words and punctuation are used; the lemmatizer still needs the tagger.
+# Excluded components are never deserialized, and the model loads once on first use.
+@functools.lru_cache(maxsize=1)
+def get_nlp():
+    return spacy.load("en_core_web_sm", exclude=["parser", "ner"])
 
 
 # ✅ Test route
@@ -106,9 +214,9 @@ def read_root():
     return {"message": "FastAPI is working!"}
 
 @app.get("/test-connections")
-def test_connections():
+async def test_connections(request: Request):
     try:
-        weaviate_ready = client_weaviate.is_ready()
+        weaviate_ready = await request.app.state.weaviate.is_ready()
         return {
             "openai_key_start": OPENAI_API_KEY[:8],
             "weaviate_url": WEAVIATE_URL,
@@ -118,109 +226,329 @@ def test_connections():
         return {"error": str(e)}
     
 
-def normalize_tokens(text):
-    return [token.lemma_.lower() for token in nlp(text) if not token.is_stop and not token.is_punct]
+def normalize_tokens_batch(texts):
+    return [
+        [token.lemma_.lower() for token in doc if not token.is_stop and not token.is_punct]
+        for doc in get_nlp().pipe(texts, batch_size=16)
+    ]
+
+_pending_tokenize = []
+
+async def normalize_tokens(text):
+    # Queries arriving within TOKENIZE_BATCH_WAIT of each other share one nlp.pipe call
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    _pending_tokenize.append((text, future))
+    if len(_pending_tokenize) == 1:
+        loop.call_later(TOKENIZE_BATCH_WAIT, flush_tokenize_batch)
+    return await future
+
+def flush_tokenize_batch():
+    batch = _pending_tokenize[:]
+    _pending_tokenize.clear()
+    work = asyncio.get_running_loop().run_in_executor(None, normalize_tokens_batch, [text for text, _ in batch])
+    work.add_done_callback(lambda done: resolve_tokenize_batch(batch, done))
+
+def resolve_tokenize_batch(batch, done):
+    cancelled = done.cancelled()  # e.g. the executor shut down; exception() would raise here
+    error = None if cancelled else done.exception()
+    for i, (_, future) in enumerate(batch):
+        if future.done():  # Caller went away while the batch was running
+            continue
+        if cancelled:
+            future.cancel()
+        elif error:
+            future.set_exception(error)
+        else:
+            future.set_result(done.result()[i])
+
+_VARIANT_TRANS = str.maketrans({"-": " ", ",": None})
 
+@functools.lru_cache(maxsize=1024)
 def expand_variants(term):
-    term = term.lower().strip().replace(",", "")
-    return {term, term.replace("-", " "), term.replace(" ", "-"), term.replace("-", "").replace(" ", "")}
+    # Weaviate splits tokens on hyphens, so the spaced and joined forms cover every spelling
+    spaced = term.lower().translate(_VARIANT_TRANS).strip()
+    return frozenset({spaced, spaced.replace(" ", "")})
+
+def fuzzy_terms_match(query_terms, all_tags, threshold=80, limit=3):
+    if not query_terms or not all_tags:
+        return []
+    # One C++ call scores every term against every tag; scores below the cutoff come back as 0
+    scores = rapidfuzz_process.cdist(query_terms, all_tags, scorer=fuzz.WRatio, score_cutoff=threshold, workers=-1)
+    # Same top-3 per term as process.extract: partition out the best k, then order only those
+    k = min(limit, len(all_tags))
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top = np.take_along_axis(top, np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1), axis=1)
+    # dict.fromkeys dedupes while keeping the best-scoring tags of earlier terms first
+    return list(dict.fromkeys(all_tags[col] for row, cols in enumerate(top) for col in cols if scores[row, col] >= threshold))
+
+def word_filter(prop, word, substring=True):
+    # A leading wildcard forces a scan of every token; prefix patterns stay on the inverted index
+    return Filter.by_property(prop).like(f"*{word}*" if substring else f"{word}*")
+
+def phrase_filter(prop, phrase, substring=True):
+    # Weaviate matches `like` per token, so multi-word phrases need every word present
+    words = phrase.split()
+    if len(words) == 1:
+        return word_filter(prop, words[0], substring)
+    return Filter.all_of([word_filter(prop, w, substring) for w in words])
+
+_get_result_fields = operator.itemgetter(*RESULT_PROPERTIES)
+
+def shape_result(props):
+    # Keeps only the displayed fields, dropping tags and combinedText
+    try:
+        return dict(zip(RESULT_PROPERTIES, _get_result_fields(props)))
+    except KeyError:
+        return {k: props[k] for k in RESULT_PROPERTIES if k in props}
+
+# Built once at import; the command map never changes
+# Substring patterns like the original `in sourceDetails` test; the set is small and built once
+command_where_filters = {
+    cmd: Filter.any_of([phrase_filter("sourceDetails", k) for k in keywords])
+    for cmd, keywords in command_filters.items()
+}
 
-def fuzzy_terms_match(query_terms, all_tags, threshold=80):
-    results = []
-    for term in query_terms:
-        matches = rapidfuzz_process.extract(term, all_tags, limit=3)
-        results.extend([m[0] for m in matches if m[1] >= threshold])
-    return list(set(results))
+async def fetch_matching(collection, flt, limit=MAX_RESULTS, properties=RESULT_PROPERTIES):
+    response = await collection.query.fetch_objects(
+        filters=flt,
+        limit=limit,
+        return_properties=properties
+    )
+    return [o.properties for o in response.objects]
+
+def contains_variant(props, variants):
+    # Same normalization as expand_variants, so spaced and joined forms compare as substrings
+    text = props.get("combinedText", "").lower().translate(_VARIANT_TRANS)
+    return any(v in text for v in variants)
+
+_tag_cache = TTLCache(maxsize=1, ttl=TAG_CACHE_TTL)
+_tag_lock = asyncio.Lock()
+
+async def get_all_tags(collection, refresh=False):
+    # Held across the fetch so concurrent cache misses share one Weaviate scan
+    async with _tag_lock:
+        tags = None if refresh else _tag_cache.get("tags")
+        if tags is None:
+            all_objs = (await collection.query.fetch_objects(limit=1000, return_properties=["tags"])).objects
+            tags = tuple(sorted(set(tag for obj in all_objs for tag in obj.properties.get("tags") or [])))
+            _tag_cache["tags"] = tags
+        return tags
+
+async def warm_up(collection):
+    # Tags are re-read before they expire, so requests never find the cache cold
+    try:
+        await get_all_tags(collection, refresh=True)
+    except Exception:
+        logger.exception("⚠️ Tag vocabulary refresh failed")
+    # A tiny hybrid query keeps the vector index in memory
+    try:
+        await collection.query.hybrid(query="inventory valuation", limit=1, return_properties=["question"])
+    except Exception:
+        logger.exception("⚠️ Weaviate warm-up failed")
+
+async def keep_warm(collection):
+    while True:
+        await asyncio.sleep(WARMUP_INTERVAL)
+        await warm_up(collection)
+
+log_q = queue.Queue(maxsize=10000)
 
 def log_query(original, rewritten, method, count):
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open("query_log.csv", "a", newline="") as f:
-        writer = csv.writer(f)
-        if f.tell() == 0:
-            writer.writerow(["Timestamp", "Original", "Rewritten", "Method", "Count"])
-        writer.writerow([timestamp, original, rewritten, method, count])
+    try:
+        log_q.put_nowait([timestamp, original, rewritten, method, count])
+    except queue.Full:
+        logger.warning("⚠️ Query log queue full, dropping row")
+
+def ensure_log_header():
+    # Checked once at startup so the writer only ever appends
+    if not os.path.exists(LOG_PATH) or os.path.getsize(LOG_PATH) == 0:
+        with open(LOG_PATH, "w", newline="") as f:
+            csv.writer(f).writerow(LOG_HEADER)
+
+def write_log_rows(rows):
+    with open(LOG_PATH, "a", newline="") as f:
+        csv.writer(f).writerows(rows)
+
+def log_writer():
+    while True:
+        batch = [log_q.get()]
+        deadline = time.monotonic() + LOG_BATCH_WAIT
+        while len(batch) < LOG_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(log_q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            write_log_rows(batch)
+        except Exception:
+            logger.exception("❌ Query log write failed")
+        finally:
+            for _ in batch:
+                log_q.task_done()
+
+def drain_log_queue(timeout):
+    # Queue.join() with a deadline, so a hung write cannot hold shutdown forever
+    with log_q.all_tasks_done:
+        return log_q.all_tasks_done.wait_for(lambda: not log_q.unfinished_tasks, timeout)
+
+# Built once at import; only the query text changes per request
+HYBRID_SEARCH_ARGS = {
+    "alpha": 0.5,
+    "limit": 10,
+    "query_properties": ["question^2", "tags^2", "combinedText"],  # Tag hits outrank body-text hits
+    "fusion_type": HybridFusion.RELATIVE_SCORE,
+    "max_vector_distance": 0.5,  # Same cut as the old certainty >= 0.75 check
+    "return_metadata": MetadataQuery(score=True),
+    "return_properties": RESULT_PROPERTIES  # Skip combinedText and tags, which are never returned
+}
+FUZZY_BM25_ARGS = {
+    "query_properties": ["tags^3", "combinedText"],
+    "limit": MAX_RESULTS,
+    "return_properties": RESULT_PROPERTIES
+}
+
+async def semantic_search(collection, rewritten):
+    try:
+        # One hybrid call covers both vector and keyword (BM25) matches
+        sem = await collection.query.hybrid(query=rewritten, **HYBRID_SEARCH_ARGS)
+        objects = sem.objects if sem else []
+
+        if objects:
+            logger.info("✅ Hybrid results returned: %d", len(objects))
+            for obj in objects:
+                logger.debug("🔷 Score: %.3f | %s", obj.metadata.score or 0, obj.properties.get("question", "")[:60])
+        else:
+            logger.info("⚠️ Hybrid search returned no results")
+
+    except Exception:
+        logger.exception("❌ Hybrid search failed")
+        objects = []
+
+    return objects
+
+async def fuzzy_search(collection, tokens):
+    tokens = list(dict.fromkeys(tokens))  # Repeated words add nothing to scoring or filters
+    if not tokens:
+        return []
+    all_tags = await get_all_tags(collection)
+    matched_tags = await asyncio.to_thread(fuzzy_terms_match, tokens, all_tags)
+
+    # BM25 ranks server-side, weighting tag hits above body-text hits
+    response = await collection.query.bm25(query=" ".join(dict.fromkeys(chain(tokens, matched_tags))), **FUZZY_BM25_ARGS)
+    if response.objects:
+        return [o.properties for o in response.objects]
+
+    # BM25 only matches whole tokens; prefix matching still catches longer word forms
+    conditions = [word_filter("combinedText", t, substring=False) for t in tokens]
+    if matched_tags:
+        conditions.append(Filter.by_property("tags").contains_any(matched_tags))
+    return await fetch_matching(collection, Filter.any_of(conditions))
+
+_query_cache = TTLCache(maxsize=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL)  # query key -> (numbers, (method, results))
+NUMBER_PATTERN = re.compile(r"\d+")
+
+def query_numbers(key):
+    # "ind as 16" and "ind as 116" or "mtp may 2023" and "mtp may 2024" are different questions
+    return tuple(sorted(NUMBER_PATTERN.findall(key)))
+
+def query_cache_get(key):
+    entry = _query_cache.get(key)
+    if entry is None and _query_cache:
+        _query_cache.expire()  # Stale rows must not win the near-match below
+        numbers = query_numbers(key)
+        candidates = [cached for cached, (cached_numbers, _) in _query_cache.items() if cached_numbers == numbers]
+        # Reordered words and small typos still hit; scored locally in one rapidfuzz call
+        match = rapidfuzz_process.extractOne(
+            key, candidates, scorer=fuzz.token_sort_ratio, score_cutoff=QUERY_CACHE_THRESHOLD
+        )
+        if match:
+            entry = _query_cache.get(match[0])
+    return entry[1] if entry is not None else None
+
+def query_cache_store(key, value):
+    _query_cache[key] = (query_numbers(key), value)
+
+_inflight_queries = {}  # query key -> task running the cache-miss path
+
+async def search_free_text(collection, raw_query, query_key):
+    spell_checked = await asyncio.to_thread(correct_spelling, raw_query) if ENABLE_SPELL_CORRECTION else raw_query
+    rewritten = await rewrite_query(spell_checked)
+    logger.info("✅ Spell Checked Query: %s (Correction %s)", spell_checked, "On" if ENABLE_SPELL_CORRECTION else "Off")
+    logger.info("✅ Rewritten Query: %s", rewritten)
+    method = "Semantic"
+
+    objects = await semantic_search(collection, rewritten)
+
+    if objects:
+        results = [obj.properties for obj in objects]
+
+    else:
+        method = "Fuzzy"
+        # Tokenized only here; most queries are answered by the hybrid search and never need it
+        tokens = await normalize_tokens(raw_query)
+        results = await fuzzy_search(collection, tokens)
+
+    if results:
+        query_cache_store(query_key, (method, results[:MAX_RESULTS]))
+    return method, results
+
 class QueryInput(BaseModel):
-    query: str
+    # Empty, one-character and oversized queries are rejected with a 422 before any search work
+    query: constr(strip_whitespace=True, min_length=MIN_QUERY_LENGTH, max_length=MAX_QUERY_LENGTH)
 
 
 @app.post("/process")
-def process_query(payload: QueryInput):
-    raw_query = payload.query.strip()
+async def process_query(payload: QueryInput, request: Request):
+    raw_query = payload.query  # Already stripped by QueryInput
+    query_key = " ".join(raw_query.casefold().split())  # Normalized once for the command map and the cache
+    collection = request.app.state.collection
 
     results = []
 
-    if raw_query.lower() in command_filters:
-        filters = command_filters[raw_query.lower()]
-        all_objs = collection.query.fetch_objects(limit=1000).objects
-        results = [o.properties for o in all_objs if any(f in o.properties.get("sourceDetails", "").lower() for f in filters)]
+    command_where = command_where_filters.get(query_key)
+
+    if command_where is not None:
+        results = await fetch_matching(collection, command_where)
         method = "Command Filter"
 
     elif raw_query.startswith("#"):
-        term = correct_spelling(raw_query[1:])
-        variants = expand_variants(term)
-        all_objs = collection.query.fetch_objects(limit=1000).objects
-        for obj in all_objs:
-            qtext = obj.properties.get("combinedText", "").lower().replace("-", " ").replace(",", "")
-            if any(v in qtext for v in variants):
-                results.append(obj.properties)
+        term = await asyncio.to_thread(correct_spelling, raw_query[1:])
+        variants = {v for v in expand_variants(term) if v}
+        if variants:
+            candidates = await fetch_matching(
+                collection,
+                Filter.any_of([phrase_filter("combinedText", v) for v in variants]),
+                limit=HASHTAG_CANDIDATE_LIMIT,
+                properties=RESULT_PROPERTIES + ["combinedText"]
+            )
+            # The filter only proves every word is present; keep rows that contain the phrase itself
+            results = [props for props in candidates if contains_variant(props, variants)]
         method = "Hashtag"
 
     else:
-        spell_checked = correct_spelling(raw_query) if ENABLE_SPELL_CORRECTION else raw_query
-        rewritten = rewrite_query(spell_checked)
-        print(f"✅ Spell Checked Query: {spell_checked} (Correction {'On' if ENABLE_SPELL_CORRECTION else 'Off'})")
-        print("✅ Rewritten Query:", rewritten)
-        method = "Semantic"
-
-        try:
-            sem = collection.query.near_text(
-                query=rewritten,
-                distance=0.7,
-                limit=10,
-                return_metadata=["certainty"]
-            )
+        cached_hit = query_cache_get(query_key)
 
-            if sem and sem.objects:
-                print(f"✅ Semantic results returned: {len(sem.objects)}")
-                for obj in sem.objects:
-                    certainty = getattr(obj.metadata, "certainty", 0)
-                    preview = obj.properties.get("question", "")[:60]
-                    print(f"🔷 Certainty: {certainty:.3f} | {preview}")
-
-                objects = [
-                    obj for obj in sem.objects
-                    if hasattr(obj.metadata, "certainty") and obj.metadata.certainty >= 0.75
-                ]
-                print(f"🎯 High-certainty matches: {len(objects)}")
-            else:
-                print("⚠️ Semantic returned no results")
-                objects = []
-
-        except Exception as e:
-            print("❌ Semantic search failed:", e)
-            objects = []
-
-        # ✅ Debug output
-        print("✅ Rewritten Query:", rewritten)
-        print("✅ Total Semantic Matches:", len(objects))
-        for i, obj in enumerate(objects[:5]):
-            print(f"{i+1}.", obj.properties.get("question", "")[:80])
-        
+        if cached_hit is not None:
+            method, results = cached_hit
+            logger.info("⚡ Query cache hit (%s): %s", method, query_key)
 
-        if objects:
-            results = [obj.properties for obj in objects]
-            
         else:
-            method = "Fuzzy"
-            tokens = normalize_tokens(raw_query)
-            all_objs = collection.query.fetch_objects(limit=1000).objects
-            results = []
-            for obj in all_objs:
-                text = obj.properties.get("combinedText", "").lower()
-                if any(token in text for token in tokens):
-                    results.append(obj.properties)
-
-    results = results[:50]  # Limit to 50 results max
+            # openai.aiosession is a ContextVar and values set in the lifespan never reach request tasks
+            openai.aiosession.set(request.app.state.openai_session)
+            # Concurrent requests for the same query share one spell check, rewrite and search
+            task = _inflight_queries.get(query_key)
+            if task is None:
+                task = asyncio.ensure_future(search_free_text(collection, raw_query, query_key))
+                _inflight_queries[query_key] = task
+                task.add_done_callback(lambda _: _inflight_queries.pop(query_key, None))
+            method, results = await asyncio.shield(task)  # One caller disconnecting must not cancel the others
+
+    results = results[:MAX_RESULTS]  # Limit to 50 results max
 
     # 🔍 Modified preview format: "1. question preview text"
     preview = [
@@ -229,14 +557,12 @@ def process_query(payload: QueryInput):
     ]
 
     # 🔍 Clean full_data: exclude tags and combinedText
-    full_data = {
-        str(idx + 1): {k: v for k, v in q.items() if k not in ["tags", "combinedText"]}
-        for idx, q in enumerate(results)
-    }
+    full_data = {str(idx + 1): shape_result(q) for idx, q in enumerate(results)}
 
     log_query(raw_query, raw_query, method, len(results))
 
-    return {
+    # Returning the response directly skips FastAPI's pure-Python jsonable_encoder pass
+    return ORJSONResponse({
         "preview": preview,
         "full_data": full_data
-    }
+    })